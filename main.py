@@ -5,16 +5,29 @@ This application analyzes video footage from a garbage truck's point of view
 to detect potential safety issues when collecting trash.
 """
 import argparse
-import json
+import asyncio
+import itertools
+import queue
 import sys
+import threading
 import time
-import concurrent.futures
+import zipfile
 from pathlib import Path
 from tqdm import tqdm
 import cv2
+import numpy as np
+import orjson
 
-from src.detection.safety_analyzer import SafetyAnalyzer
+from src.detection.safety_analyzer import JPEG_QUALITY, MAX_IMAGE_DIMENSION, SafetyAnalyzer, SafetyIssue
 from src.video.processor import VideoProcessor
+from src.video.processor_gpu import GPUVideoProcessor
+
+
+# The auto decoder seeks once the interval spans at least this many seconds of video.
+# Each seek decodes from the previous keyframe; on the bundled 30 fps example seeking
+# took 19s against 11s for decoding every frame at a 2s interval, broke even near 4s
+# and took 6s against 11s at 6.7s.
+SEEK_MIN_INTERVAL_SECONDS = 5
 
 
 def parse_arguments():
@@ -33,12 +46,31 @@ def parse_arguments():
         default="safety_report.json",
         help="Path to save the safety report (default: safety_report.json)"
     )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also save the detected issues as a Parquet table next to the report "
+             "(requires the optional parquet dependencies)"
+    )
     parser.add_argument(
         "-n", "--frame-interval",
         type=int,
         default=30,
         help="Analyze every n-th frame (default: 30)"
     )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Analyze frames less often while there is little motion, up to every "
+             "8n-th frame, and every n-th frame again once motion is detected"
+    )
+    parser.add_argument(
+        "--motion-threshold",
+        type=float,
+        default=0.05,
+        help="Fraction of pixels that must change for a frame to count as moving "
+             "with --adaptive (default: 0.05)"
+    )
     parser.add_argument(
         "--save-frames",
         action="store_true",
@@ -53,25 +85,49 @@ def parse_arguments():
     parser.add_argument(
         "--save-all-frames",
         action="store_true",
-        help="Save all analyzed frames regardless of safety issues"
+        help="Save all analyzed frames regardless of safety issues, as sent to the model, "
+             "in a frames.zip archive"
     )
     parser.add_argument(
         "--all-frames-dir",
         type=str,
         default="all_frames",
-        help="Directory to save all analyzed frames (default: all_frames)"
+        help="Directory to save the archive of all analyzed frames to (default: all_frames)"
     )
     parser.add_argument(
         "--workers",
         type=int,
-        default=4,
-        help="Number of parallel workers for frame analysis (default: 4)"
+        default=16,
+        help="Number of frames analyzed concurrently (default: 16)"
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=int,
+        default=6,
+        help="Reuse the result of a recently analyzed frame for frames whose perceptual "
+             "hash differs from it by fewer than this many bits; 0 disables (default: 6)"
+    )
+    parser.add_argument(
+        "--decoder",
+        choices=["auto", "sequential", "seek", "parallel", "gpu"],
+        default="auto",
+        help="How to extract frames: walk every frame (sequential), seek to each "
+             "analyzed frame (seek), decode segments on all CPU cores (parallel), "
+             "decode and JPEG-encode on an NVIDIA GPU (gpu), or pick between "
+             "sequential and seek based on the interval (default: auto)"
+    )
+    parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=8,
+        help="Number of threads used to decode the video (default: 8)"
     )
     parser.add_argument(
         "--batch-size",
         type=int,
-        default=10,
-        help="Number of frames to process in each batch (default: 10)"
+        default=1,
+        help="Number of frames tiled into one image per API request; 1 sends each "
+             "frame on its own (default: 1)"
     )
     
     return parser.parse_args()
@@ -90,28 +146,199 @@ def prompt_for_frame_interval():
             print("Please enter a valid number.")
 
 
-def analyze_frame_task(args):
+def save_frame(frame, frame_path):
+    """
+    Save a frame to disk.
+    
+    Args:
+        frame (numpy.ndarray or bytes): The frame, or a frame that is already JPEG-encoded
+        frame_path (Path): The path to save the frame to
+    """
+    if isinstance(frame, bytes):
+        frame_path.write_bytes(frame)
+    else:
+        cv2.imwrite(str(frame_path), frame)
+
+
+def load_detected_issues(issues_path):
+    """
+    Load the streamed detected issues, sorted by frame number.
+    
+    Args:
+        issues_path (Path): The JSON Lines file the issues were streamed to
+    
+    Returns:
+        list: The detected issues (dicts with frame_number, timestamp and issue_details)
+    """
+    with open(issues_path, "rb") as issues_file:
+        detected_issues = [orjson.loads(line) for line in issues_file]
+    
+    # Results arrive in completion order; report them in video order
+    return sorted(detected_issues, key=lambda issue: issue["frame_number"])
+
+
+def issues_to_columns(detected_issues):
+    """
+    Flatten detected issues into one list per field, for columnar formats.
+    
+    Args:
+        detected_issues (list): The detected issues, as returned by load_detected_issues
+    
+    Returns:
+        dict: The frame_number and timestamp lists, plus one list per SafetyIssue field
+    """
+    columns = {
+        "frame_number": [issue["frame_number"] for issue in detected_issues],
+        "timestamp": [issue["timestamp"] for issue in detected_issues]
+    }
+    for field in SafetyIssue.model_fields:
+        columns[field] = [issue["issue_details"][field] for issue in detected_issues]
+    return columns
+
+
+class FrameWriter:
+    """
+    A class to save frames to disk from a background thread.
+    
+    Keeps JPEG encoding and disk writes off the path of the API requests. Frames
+    can be saved as individual files or appended to a single uncompressed zip
+    archive, which avoids creating one file per frame.
+    """
+    
+    def __init__(self, archive_path=None, max_pending=32):
+        """
+        Initialize the frame writer and start its thread.
+        
+        Args:
+            archive_path (Path, optional): Path of the zip archive to create for archive()
+            max_pending (int): Maximum number of frames waiting to be saved
+        """
+        # JPEGs are already compressed, so they are stored as-is
+        self._archive = None
+        if archive_path is not None:
+            self._archive = zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_STORED)
+        
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    async def save(self, frame, frame_path):
+        """
+        Queue a frame to be saved, waiting while the queue is full.
+        
+        The wait happens in a worker thread, so the event loop and the API requests
+        in flight keep running while the disk catches up.
+        
+        Args:
+            frame (numpy.ndarray or bytes): The frame, or a frame that is already JPEG-encoded
+            frame_path (Path): The path to save the frame to
+        """
+        await asyncio.to_thread(self._queue.put, (save_frame, (frame, frame_path)))
+    
+    async def archive(self, jpeg, name):
+        """
+        Queue a JPEG-encoded frame to be added to the archive, waiting while the queue is full.
+        
+        Args:
+            jpeg (bytes): The JPEG-encoded frame
+            name (str): The file name of the frame in the archive
+        """
+        await asyncio.to_thread(self._queue.put, (self._archive.writestr, (name, jpeg)))
+    
+    def close(self):
+        """Wait for all queued frames to be saved, stop the thread and close the archive."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._archive is not None:
+            self._archive.close()
+    
+    def _run(self):
+        """Save queued frames until close() is called."""
+        # Only this thread touches the archive, so its writes need no lock
+        while (item := self._queue.get()) is not None:
+            write, write_args = item
+            try:
+                write(*write_args)
+            except Exception as e:
+                print(f"Error saving frame: {e}")
+
+
+async def analyze_batch_task(batch, timestamps, analyzer, save_all_frames, frame_writer):
     """
-    Task function for parallel processing of frames.
+    Task coroutine for concurrent processing of a batch of frames.
     
     Args:
-        args (tuple): Tuple containing (frame_number, frame, timestamp, analyzer, all_frames_dir)
+        batch (tuple): (frame_number, frame) tuples analyzed in one API request
+        timestamps (dict): Maps frame numbers to their timestamps
+        analyzer (SafetyAnalyzer): The safety analyzer
+        save_all_frames (bool): Whether to archive every analyzed frame
+        frame_writer (FrameWriter): Saves the frames in the background
         
     Returns:
-        tuple: (frame_number, timestamp, analysis_result, frame)
+        list: (frame_number, timestamp, analysis_result, frame) tuples
     """
-    frame_number, frame, timestamp, analyzer, all_frames_dir = args
+    frame_numbers = [frame_number for frame_number, _ in batch]
+    frames = [frame for _, frame in batch]
+    batch_timestamps = [timestamps[frame_number] for frame_number in frame_numbers]
     
-    # Save the frame if save_all_frames is enabled
-    if all_frames_dir:
-        frame_filename = f"frame_{frame_number:06d}_{timestamp.replace(':', '_')}.jpg"
-        frame_path = all_frames_dir / frame_filename
-        cv2.imwrite(str(frame_path), frame)
+    # Archive the frames if save_all_frames is enabled, as the same JPEGs sent to the API
+    jpegs = None
+    if save_all_frames:
+        jpegs = [await asyncio.to_thread(analyzer.encode_frame, frame) for frame in frames]
+        for frame_number, jpeg, timestamp in zip(frame_numbers, jpegs, batch_timestamps):
+            await frame_writer.archive(jpeg, f"frame_{frame_number:06d}_{timestamp.replace(':', '_')}.jpg")
+    
+    # Analyze the frames for safety issues, reusing the JPEG if it was already encoded
+    if len(frames) == 1:
+        analysis_results = [await analyzer.analyze_frame(jpegs[0] if jpegs else frames[0])]
+    else:
+        analysis_results = await analyzer.analyze_batch(frames)
+    
+    return list(zip(frame_numbers, batch_timestamps, analysis_results, frames))
+
+
+async def analyze_frames(frames, timestamps, analyzer, save_all_frames, frame_writer, workers, batch_size,
+                         handle_result):
+    """
+    Analyze frames concurrently while they are being decoded.
+    
+    Each batch is decoded in a background thread and fed to a bounded queue, so
+    decoding never gets more than two batches per worker ahead of the API calls.
+    Each worker pulls batches from the queue and keeps one request in flight. The
+    producer is a task like the workers, so if any of them fails the others are
+    cancelled and the error propagates instead of leaving decoding blocked.
+    
+    Args:
+        frames (iterable): (frame_number, frame) tuples to analyze
+        timestamps (dict): Maps frame numbers to their timestamps
+        analyzer (SafetyAnalyzer): The safety analyzer
+        save_all_frames (bool): Whether to archive every analyzed frame
+        frame_writer (FrameWriter): Saves the frames in the background
+        workers (int): Number of batches analyzed concurrently
+        batch_size (int): Number of frames analyzed in each API request
+        handle_result (callable): Coroutine function awaited with (frame_number, timestamp,
+            analysis_result, frame) as soon as each analysis completes
+    """
+    batches = asyncio.Queue(maxsize=2 * workers)
+    
+    async def produce():
+        batch_iter = itertools.batched(frames, batch_size)
+        while (batch := await asyncio.to_thread(next, batch_iter, None)) is not None:
+            await batches.put(batch)
+        
+        # One sentinel per worker tells them all to stop
+        for _ in range(workers):
+            await batches.put(None)
     
-    # Analyze the frame for safety issues
-    analysis_result = analyzer.analyze_frame(frame)
+    async def consume():
+        while (batch := await batches.get()) is not None:
+            for result in await analyze_batch_task(batch, timestamps, analyzer, save_all_frames, frame_writer):
+                await handle_result(*result)
     
-    return frame_number, timestamp, analysis_result, frame
+    async with asyncio.TaskGroup() as task_group:
+        task_group.create_task(produce())
+        for _ in range(workers):
+            task_group.create_task(consume())
 
 
 def main():
@@ -125,6 +352,18 @@ def main():
         print(f"Error: Video file not found: {video_path}")
         sys.exit(1)
     
+    if args.workers < 1:
+        print("Error: --workers must be at least 1")
+        sys.exit(1)
+    
+    if args.batch_size < 1:
+        print("Error: --batch-size must be at least 1")
+        sys.exit(1)
+    
+    if args.adaptive and args.decoder not in ("auto", "sequential"):
+        print(f"Error: --adaptive decodes the video sequentially and cannot be used with --decoder {args.decoder}")
+        sys.exit(1)
+    
     # Only prompt for frame interval if it wasn't specified in command line arguments
     if args.frame_interval is None:
         frame_interval = prompt_for_frame_interval()
@@ -135,7 +374,7 @@ def main():
     
     # Initialize the video processor
     try:
-        video_processor = VideoProcessor(video_path)
+        video_processor = VideoProcessor(video_path, decode_threads=args.decode_threads)
     except Exception as e:
         print(f"Error initializing video processor: {e}")
         sys.exit(1)
@@ -147,16 +386,19 @@ def main():
     print(f"FPS: {video_processor.fps}")
     print(f"Resolution: {video_processor.width}x{video_processor.height}")
     
-    # Calculate number of frames to process
-    num_frames_to_process = video_processor.frame_count // frame_interval
-    if video_processor.frame_count % frame_interval > 0:
-        num_frames_to_process += 1
+    # Calculate the frames to process and their timestamps
+    frame_numbers = np.arange(0, video_processor.frame_count, frame_interval)
+    timestamps = dict(zip(frame_numbers.tolist(), video_processor.timestamps_for(frame_numbers)))
+    num_frames_to_process = len(frame_numbers)
     
-    print(f"Analyzing {num_frames_to_process} frames with {args.workers} parallel workers...\n")
+    if args.adaptive:
+        print(f"Analyzing up to {num_frames_to_process} frames with {args.workers} concurrent workers...\n")
+    else:
+        print(f"Analyzing {num_frames_to_process} frames with {args.workers} concurrent workers...\n")
     
     # Initialize the safety analyzer
     try:
-        safety_analyzer = SafetyAnalyzer()
+        safety_analyzer = SafetyAnalyzer(dedup_threshold=args.dedup_threshold, max_connections=args.workers)
     except Exception as e:
         print(f"Error initializing safety analyzer: {e}")
         sys.exit(1)
@@ -168,12 +410,13 @@ def main():
         frames_dir.mkdir(parents=True, exist_ok=True)
         print(f"Frames with detected issues will be saved to: {frames_dir}")
     
-    # Create output directory for all frames if needed
-    all_frames_dir = None
+    # Create output directory and archive for all frames if needed
+    all_frames_archive = None
     if args.save_all_frames:
         all_frames_dir = Path(args.all_frames_dir)
         all_frames_dir.mkdir(parents=True, exist_ok=True)
-        print(f"All analyzed frames will be saved to: {all_frames_dir}")
+        all_frames_archive = all_frames_dir / "frames.zip"
+        print(f"All analyzed frames will be saved to: {all_frames_archive}")
     
     # Process the video and analyze frames
     safety_report = {
@@ -183,55 +426,105 @@ def main():
         "detected_issues": []
     }
     
-    # Prepare frame batches for parallel processing
-    frame_batches = []
-    for frame_number, frame in video_processor.get_frame_at_intervals(frame_interval):
-        timestamp = video_processor.get_frame_timestamp(frame_number)
-        frame_batches.append((frame_number, frame, timestamp, safety_analyzer, all_frames_dir))
+    # Detected issues are streamed to a JSON Lines file as they are found
+    output_path = Path(args.output)
+    # A suffix is added to the stem, so the side files never replace the report itself
+    issues_path = output_path.with_name(output_path.stem + "_issues.jsonl")
     
-    # Process frames in parallel
+    parquet_path = None
+    if args.parquet:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("Error: --parquet requires the optional parquet dependencies. "
+                  "Install them with: uv sync --extra parquet")
+            sys.exit(1)
+        parquet_path = output_path.with_name(output_path.stem + "_issues.parquet")
+    
+    # Seeking only pays off when the interval spans several seconds of video
+    decoder = args.decoder
+    if decoder == "auto":
+        decoder = "seek" if frame_interval >= video_processor.fps * SEEK_MIN_INTERVAL_SECONDS else "sequential"
+    
+    if args.adaptive:
+        frames = video_processor.get_motion_gated_frames(frame_interval, frame_interval * 8, args.motion_threshold)
+    elif decoder == "seek":
+        frames = video_processor.get_frame_at_intervals_seek(frame_interval)
+    elif decoder == "parallel":
+        frames = video_processor.get_frame_at_intervals_parallel(frame_interval)
+    elif decoder == "gpu":
+        try:
+            gpu_processor = GPUVideoProcessor(video_path, max_dimension=MAX_IMAGE_DIMENSION,
+                                              jpeg_quality=JPEG_QUALITY)
+        except Exception as e:
+            print(f"Error initializing GPU video processor: {e}")
+            sys.exit(1)
+        # The timestamps are computed for OpenCV's frame count, which may differ from the GPU decoder's
+        frames = gpu_processor.get_frame_at_intervals(frame_interval, video_processor.frame_count)
+    else:
+        frames = video_processor.get_frame_at_intervals(frame_interval)
+    
+    # Process frames concurrently
+    frames_processed = 0
     issues_count = 0
+    frame_writer = FrameWriter(all_frames_archive)
     
-    # Use ThreadPoolExecutor for I/O-bound operations (API calls)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-        # Submit all tasks and get futures
-        with tqdm(total=len(frame_batches), desc="Analyzing frames") as progress_bar:
-            # Process results as they complete
-            for frame_number, timestamp, analysis_result, frame in executor.map(analyze_frame_task, frame_batches):
-                # Process the results
-                safety_issues = analysis_result.get("safety_issues", [])
-                if safety_issues:
-                    issues_count += len(safety_issues)
-                    
-                    # Add the issues to the report
-                    for issue in safety_issues:
-                        safety_report["detected_issues"].append({
-                            "frame_number": frame_number,
-                            "timestamp": timestamp,
-                            "issue_details": issue
-                        })
-                    
-                    # Save the frame if requested
-                    if args.save_frames:
-                        frame_filename = f"issue_frame_{frame_number:06d}_{timestamp.replace(':', '_')}.jpg"
-                        frame_path = frames_dir / frame_filename
-                        cv2.imwrite(str(frame_path), frame)
+    with open(issues_path, "wb") as issues_file, \
+            tqdm(total=None if args.adaptive else num_frames_to_process, desc="Analyzing frames") as progress_bar:
+        async def handle_result(frame_number, timestamp, analysis_result, frame):
+            nonlocal frames_processed, issues_count
+            
+            # Process the results
+            safety_issues = analysis_result.get("safety_issues", [])
+            if safety_issues:
+                issues_count += len(safety_issues)
+                
+                # Add the issues to the report
+                for issue in safety_issues:
+                    issues_file.write(orjson.dumps({
+                        "frame_number": frame_number,
+                        "timestamp": timestamp,
+                        "issue_details": issue
+                    }) + b"\n")
                 
-                # Update the progress bar
-                progress_bar.update(1)
+                # Save the frame if requested
+                if args.save_frames:
+                    frame_filename = f"issue_frame_{frame_number:06d}_{timestamp.replace(':', '_')}.jpg"
+                    frame_path = frames_dir / frame_filename
+                    await frame_writer.save(frame, frame_path)
+            
+            # Update the progress bar
+            frames_processed += 1
+            progress_bar.update(1)
+        
+        try:
+            asyncio.run(analyze_frames(frames, timestamps, safety_analyzer, args.save_all_frames, frame_writer,
+                                       args.workers, args.batch_size, handle_result))
+        finally:
+            frame_writer.close()
+    
+    safety_report["detected_issues"] = load_detected_issues(issues_path)
+    
+    # Save the detected issues as a columnar table if requested
+    if parquet_path:
+        table = pyarrow.Table.from_pydict(issues_to_columns(safety_report["detected_issues"]))
+        pyarrow.parquet.write_table(table, parquet_path)
     
     # Save the safety report
-    output_path = Path(args.output)
-    with open(output_path, "w") as f:
-        json.dump(safety_report, f, indent=2)
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(safety_report, option=orjson.OPT_INDENT_2))
     
     # Print summary
     print(f"\nAnalysis complete!")
-    print(f"Processed {len(frame_batches)} frames")
+    print(f"Processed {frames_processed} frames")
     print(f"Detected {issues_count} safety issues")
     if args.save_all_frames:
-        print(f"All analyzed frames saved to: {all_frames_dir}")
+        print(f"All analyzed frames saved to: {all_frames_archive}")
     print(f"Safety report saved to: {output_path}")
+    print(f"Detected issues streamed to: {issues_path}")
+    if parquet_path:
+        print(f"Detected issues table saved to: {parquet_path}")
     
     # Cleanup
     del video_processor
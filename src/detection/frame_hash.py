@@ -0,0 +1,47 @@
+"""
+Perceptual hashing module for detecting near-duplicate video frames.
+"""
+import cv2
+import numpy as np
+
+
+def perceptual_hash(frame):
+    """
+    Compute a 64-bit DCT-based perceptual hash (pHash) of a frame.
+    
+    Frames that look alike have hashes that differ in only a few bits, so the
+    Hamming distance between two hashes measures how different the frames are.
+    
+    Args:
+        frame (numpy.ndarray or bytes): The video frame, or a JPEG-encoded frame
+    
+    Returns:
+        numpy.uint64: The 64-bit hash
+    """
+    if isinstance(frame, bytes):
+        # Decoding at 1/8 scale only reads the DC coefficients, which is much cheaper
+        gray = cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    else:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA)
+    low_frequencies = cv2.dct(np.float32(small))[:8, :8]
+    bits = (low_frequencies > np.median(low_frequencies)).flatten()
+    return np.packbits(bits).view(">u8")[0].astype(np.uint64)
+
+
+def hamming_distances(frame_hash, hashes):
+    """
+    Count the bits that differ between a perceptual hash and each of several others.
+    
+    np.bitwise_count compiles to the CPU's popcount instruction, so the whole
+    array is compared without a Python-level loop.
+    
+    Args:
+        frame_hash (numpy.uint64): The hash to compare
+        hashes (numpy.ndarray): The uint64 hashes to compare against
+    
+    Returns:
+        numpy.ndarray: The number of differing bits (0-64) for each of hashes
+    """
+    return np.bitwise_count(np.bitwise_xor(hashes, frame_hash))
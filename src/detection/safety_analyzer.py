@@ -1,16 +1,55 @@
 """
 Safety analyzer module for detecting safety issues in garbage collection video frames.
 """
+import asyncio
 import base64
-import io
+import collections
+import math
 import cv2
-from openai import OpenAI
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from pydantic import BaseModel, Field
 from typing import List, Optional
 
+try:
+    from turbojpeg import TJSAMP_420, TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+from src.detection.frame_hash import hamming_distances, perceptual_hash
 from src.utils.config import get_openai_api_key
 
 
+# Frames are downscaled so their longest side is at most this many pixels;
+# the model tiles images into 512px patches, so larger frames add little detail
+MAX_IMAGE_DIMENSION = 768
+
+JPEG_QUALITY = 80
+
+# Number of recently analyzed frames new frames are checked against for duplicates
+DEDUP_WINDOW = 8
+
+# Sent as the system message of every request. It must not change between requests
+# so the API can reuse its cached prefix instead of processing it again.
+SAFETY_PROMPT = """
+Analyze each image you are given from a garbage truck's point of view.
+Identify obvious and clear safety issues related to collecting trash from trash cans visible in the frame.
+
+Examples of safety issues to look for:
+- Fire or smoke coming from trash cans
+- Fire or smoke coming from the garbage truck itself or its collector crane.
+- Hazardous materials visible (chemical containers, batteries, etc.)
+- Dangerous and sharp objects protruding from trash cans
+- People or animals too close to the collection area
+- Weather-related hazards (ice, flooding, etc.)
+
+Issues like a vehicle being too close to the collection area are not safety issues (unless they are extremely close.)
+
+If no safety issues are detected, return an empty array.
+"""
+
+
 class SafetyIssue(BaseModel):
     """Model representing a safety issue detected in a frame."""
     issue_type: str
@@ -24,72 +63,278 @@ class SafetyAnalysisResult(BaseModel):
     error: Optional[str] = None
 
 
+class TileSafetyIssues(BaseModel):
+    """Model representing the safety issues detected in one tile of a frame mosaic."""
+    tile: int
+    safety_issues: List[SafetyIssue] = Field(default_factory=list)
+
+
+class SafetyBatchAnalysisResult(BaseModel):
+    """Model representing the result of a safety analysis of a frame mosaic."""
+    tile_results: List[TileSafetyIssues] = Field(default_factory=list)
+    error: Optional[str] = None
+
+
+def _make_strict(schema):
+    """
+    Apply the rules of the structured output strict mode to a JSON schema, in place.
+    
+    Every object must list all of its properties as required and forbid others,
+    and no property may have a default.
+    
+    Args:
+        schema (dict): A JSON schema generated by Pydantic, or a subschema of one
+    
+    Returns:
+        dict: The same schema
+    """
+    schema.pop("default", None)
+    if "properties" in schema:
+        schema["additionalProperties"] = False
+        schema["required"] = list(schema["properties"])
+        for subschema in schema["properties"].values():
+            _make_strict(subschema)
+    for subschema in schema.get("$defs", {}).values():
+        _make_strict(subschema)
+    for subschema in schema.get("anyOf", []):
+        _make_strict(subschema)
+    if "items" in schema:
+        _make_strict(schema["items"])
+    return schema
+
+
+def _response_format(model):
+    """
+    Build the structured output response format for a Pydantic model.
+    
+    Args:
+        model (type): The Pydantic model the response must follow
+    
+    Returns:
+        dict: The response_format parameter for the chat completions API
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": _make_strict(model.model_json_schema()),
+            "strict": True
+        }
+    }
+
+
 class SafetyAnalyzer:
     """
     A class to analyze video frames for safety issues using OpenAI.
     """
     
-    def __init__(self):
-        """Initialize the safety analyzer with OpenAI client."""
+    # The JSON schemas are generated once instead of on every request
+    _RESPONSE_FORMATS = {
+        SafetyAnalysisResult: _response_format(SafetyAnalysisResult),
+        SafetyBatchAnalysisResult: _response_format(SafetyBatchAnalysisResult),
+    }
+    
+    # Identical leading messages of every request; only the image follows them
+    _MESSAGES_PREFIX = [{"role": "system", "content": SAFETY_PROMPT}]
+    
+    def __init__(self, dedup_threshold=6, max_connections=16):
+        """
+        Initialize the safety analyzer with an async OpenAI client.
+        
+        Args:
+            dedup_threshold (int): Frames whose perceptual hash differs from one of the
+                last DEDUP_WINDOW analyzed frames by fewer than this many bits reuse its
+                result instead of calling the API. 0 disables deduplication.
+            max_connections (int): Size of the HTTP connection pool, which should
+                match the number of concurrent requests
+        """
         api_key = get_openai_api_key()
-        self.client = OpenAI(api_key=api_key)
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self.client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+        self.dedup_threshold = dedup_threshold
+        self._recent_hashes = np.empty(0, dtype=np.uint64)
+        self._recent_analyses = collections.deque(maxlen=DEDUP_WINDOW)
+        
+        # Prefer libjpeg-turbo's SIMD encoder when it is installed
+        self._jpeg = None
+        if TurboJPEG is not None:
+            try:
+                self._jpeg = TurboJPEG()
+            except (OSError, RuntimeError):
+                # PyTurboJPEG is installed but the libturbojpeg library is not
+                pass
+    
+    def encode_frame(self, frame, max_dimension=MAX_IMAGE_DIMENSION):
+        """
+        Downscale a frame and encode it as JPEG for the API.
+        
+        Args:
+            frame (numpy.ndarray or bytes): The video frame, or a frame that is
+                already JPEG-encoded (e.g. by the GPU decoder)
+            max_dimension (int): Maximum length of the longest side in pixels
+        
+        Returns:
+            bytes: The JPEG-encoded frame
+        """
+        if isinstance(frame, bytes):
+            return frame
+        
+        h, w = frame.shape[:2]
+        scale = max_dimension / max(h, w)
+        if scale < 1:
+            frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        
+        if self._jpeg is not None:
+            return self._jpeg.encode(frame, quality=JPEG_QUALITY, jpeg_subsample=TJSAMP_420)
+        
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        return buffer.tobytes()
     
-    def analyze_frame(self, frame):
+    async def analyze_frame(self, frame):
         """
         Analyze a frame for safety issues related to garbage collection.
         
+        Near-duplicates of recently analyzed frames are not sent to the API; they
+        get the same result as the closest of those frames.
+        
         Args:
-            frame (numpy.ndarray): The video frame to analyze
+            frame (numpy.ndarray or bytes): The video frame to analyze, or a
+                frame that is already JPEG-encoded
         
         Returns:
             dict: Analysis results with detected safety issues
         """
-        # Convert the frame to a base64 string for the API
-        _, buffer = cv2.imencode('.jpg', frame)
-        img_bytes = io.BytesIO(buffer)
-        base64_image = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
-        
-        # Prepare the prompt for the API
-        prompt = """
-        Analyze this image from a garbage truck's point of view.
-        Identify obvious and clear safety issues related to collecting trash from trash cans visible in the frame.
-        
-        Examples of safety issues to look for:
-        - Fire or smoke coming from trash cans
-        - Fire or smoke coming from the garbage truck itself or its collector crane.
-        - Hazardous materials visible (chemical containers, batteries, etc.)
-        - Dangerous and sharp objects protruding from trash cans
-        - People or animals too close to the collection area
-        - Weather-related hazards (ice, flooding, etc.)
-
-        Issues like a vehicle being too close to the collection area are not safety issues (unless they are extremely close.)
-        
-        If no safety issues are detected, return an empty array.
+        if self.dedup_threshold <= 0:
+            return await self._analyze_single_frame(frame)
+        
+        # Hash before the first await so frames are compared in the order they arrive
+        frame_hash = perceptual_hash(frame)
+        if len(self._recent_hashes):
+            distances = hamming_distances(frame_hash, self._recent_hashes)
+            closest = int(np.argmin(distances))
+            if distances[closest] < self.dedup_threshold:
+                return await self._recent_analyses[closest]
+        
+        analysis = asyncio.ensure_future(self._analyze_single_frame(frame))
+        self._recent_hashes = np.append(self._recent_hashes, frame_hash)[-DEDUP_WINDOW:]
+        self._recent_analyses.append(analysis)
+        return await analysis
+    
+    async def analyze_batch(self, frames):
+        """
+        Analyze several frames for safety issues with a single API request.
+        
+        The frames are tiled into one mosaic image and the model reports the
+        issues of each tile separately, which spreads the per-request overhead
+        over all the frames. Frames are not deduplicated.
+        
+        Args:
+            frames (list): The video frames to analyze (numpy.ndarray or JPEG bytes)
+        
+        Returns:
+            list: One analysis result dict per frame, in the same order as frames
+        """
+        mosaic, rows, columns = await asyncio.to_thread(self._build_mosaic, frames)
+        buffer = await asyncio.to_thread(self.encode_frame, mosaic, MAX_IMAGE_DIMENSION * columns)
+        
+        prompt = f"""
+        This image is a grid of {len(frames)} separate video frames arranged in {rows} rows and {columns} columns.
+        The tiles are numbered 1 to {len(frames)} from left to right, then top to bottom; any black tiles are padding.
+        Analyze each tile on its own and report the safety issues of each tile under its number.
         """
         
         try:
-            # Make the API call with structured output using parse
-            completion = self.client.beta.chat.completions.parse(
-                model="gpt-4o-2024-08-06",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                response_format=SafetyAnalysisResult,
-                max_tokens=1000
-            )
+            batch_result = await self._request_analysis(buffer, prompt, SafetyBatchAnalysisResult)
             
-            # Return the parsed result directly
-            return completion.choices[0].message.parsed.model_dump()
+            # Split the tile results back into one result per frame
+            results = [SafetyAnalysisResult(error=batch_result.error) for _ in frames]
+            for tile_result in batch_result.tile_results:
+                if 1 <= tile_result.tile <= len(frames):
+                    results[tile_result.tile - 1].safety_issues.extend(tile_result.safety_issues)
+            return [result.model_dump() for result in results]
+        except Exception as e:
+            return [SafetyAnalysisResult(safety_issues=[], error=str(e)).model_dump() for _ in frames]
+    
+    def _build_mosaic(self, frames):
+        """
+        Tile frames into a grid image, each scaled down to MAX_IMAGE_DIMENSION.
+        
+        Args:
+            frames (list): The video frames (numpy.ndarray or JPEG bytes)
+        
+        Returns:
+            tuple: (mosaic, rows, columns)
+        """
+        frames = [
+            cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR) if isinstance(frame, bytes) else frame
+            for frame in frames
+        ]
+        columns = math.ceil(math.sqrt(len(frames)))
+        rows = math.ceil(len(frames) / columns)
+        
+        h, w = frames[0].shape[:2]
+        scale = min(1, MAX_IMAGE_DIMENSION / max(h, w))
+        tile_size = (int(w * scale), int(h * scale))
+        tiles = [cv2.resize(frame, tile_size, interpolation=cv2.INTER_AREA) for frame in frames]
+        tiles += [np.zeros_like(tiles[0])] * (rows * columns - len(tiles))
+        
+        mosaic = cv2.vconcat([cv2.hconcat(tiles[row * columns:(row + 1) * columns]) for row in range(rows)])
+        return mosaic, rows, columns
+    
+    async def _analyze_single_frame(self, frame):
+        """
+        Send a frame to the API and return its analysis.
+        
+        Args:
+            frame (numpy.ndarray or bytes): The video frame to analyze, or a
+                frame that is already JPEG-encoded
+        
+        Returns:
+            dict: Analysis results with detected safety issues
+        """
+        # Convert the frame to JPEG off the event loop
+        buffer = await asyncio.to_thread(self.encode_frame, frame)
+        
+        try:
+            return (await self._request_analysis(buffer, None, SafetyAnalysisResult)).model_dump()
         except Exception as e:
-            return SafetyAnalysisResult(safety_issues=[], error=str(e)).model_dump() 
\ No newline at end of file
+            return SafetyAnalysisResult(safety_issues=[], error=str(e)).model_dump()
+    
+    async def _request_analysis(self, buffer, prompt, result_model):
+        """
+        Send a JPEG image to the API with structured output.
+        
+        Args:
+            buffer (bytes): The JPEG-encoded image
+            prompt (str or None): Extra instructions sent with this image, after
+                the shared system prompt
+            result_model (type): The Pydantic model to parse the response into
+        
+        Returns:
+            BaseModel: The parsed response
+        """
+        # b64encode reads the encoded buffer directly, without an intermediate copy
+        base64_image = base64.b64encode(buffer).decode('ascii')
+        
+        content = [
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{base64_image}"
+                }
+            }
+        ]
+        if prompt is not None:
+            content.insert(0, {"type": "text", "text": prompt})
+        
+        # Make the API call with structured output using the cached schema
+        completion = await self.client.chat.completions.create(
+            model="gpt-4o-2024-08-06",
+            messages=self._MESSAGES_PREFIX + [{"role": "user", "content": content}],
+            response_format=self._RESPONSE_FORMATS[result_model],
+            max_tokens=1000
+        )
+        
+        return result_model.model_validate_json(completion.choices[0].message.content)
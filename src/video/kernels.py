@@ -0,0 +1,31 @@
+"""
+Numba-compiled kernels for per-pixel frame computations.
+"""
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def motion_energy(prev, curr, thresh):
+    """
+    Count the pixels that changed between two grayscale frames.
+    
+    Compiled to machine code on first use (and cached on disk). The loop is
+    serial: the frames are small thumbnails, and a parallel kernel called from
+    the decoding thread can keep some Numba threading layers from shutting down.
+    
+    Args:
+        prev (numpy.ndarray): The previous frame as a 2D uint8 array
+        curr (numpy.ndarray): The current frame as a 2D uint8 array of the same shape
+        thresh (int): Minimum absolute intensity difference for a pixel to count as changed
+    
+    Returns:
+        int: The number of changed pixels
+    """
+    changed = 0
+    for i in range(prev.shape[0]):
+        for j in range(prev.shape[1]):
+            # Widen to a signed type first: uint8 subtraction would wrap around
+            if abs(np.int32(curr[i, j]) - np.int32(prev[i, j])) > thresh:
+                changed += 1
+    return changed
@@ -1,22 +1,76 @@
 """
 Video processor module for capturing, processing, and extracting frames from video.
 """
+import collections
+import concurrent.futures
+import multiprocessing
+import os
 import cv2
 import numpy as np
 from pathlib import Path
 
+from src.video.kernels import motion_energy
+
+
+# Maximum number of sampled frames each worker decodes per task in get_frame_at_intervals_parallel
+SEGMENT_SAMPLES = 8
+
+# Approximate memory budget for the decoded frames get_frame_at_intervals_parallel holds at once
+PARALLEL_DECODE_BUDGET = 256 * 1024 * 1024
+
+# Width frames are downscaled to before measuring motion in get_motion_gated_frames
+MOTION_FRAME_WIDTH = 160
+
+# Minimum grayscale intensity change for a pixel to count as moving
+MOTION_PIXEL_THRESHOLD = 25
+
+
+def _decode_segment(video_path, start, stop, interval):
+    """
+    Decode the sampled frames in [start, stop) with a private video capture.
+    
+    Runs in a worker process: it seeks once to the start of the segment and
+    walks forward from there, only retrieving frames that fall on the interval.
+    
+    Args:
+        video_path (str): Path to the video file
+        start (int): First frame number of the segment (a multiple of interval)
+        stop (int): Frame number one past the end of the segment
+        interval (int): Number of frames to skip between each sampled frame
+    
+    Returns:
+        list: (frame_number, frame) tuples for the sampled frames in the segment
+    """
+    # The pool already runs one process per core, so each decoder gets a single thread
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, 1])
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        frames = []
+        for frame_number in range(start, stop):
+            if not cap.grab():
+                break
+            if frame_number % interval == 0:
+                success, frame = cap.retrieve()
+                if not success:
+                    break
+                frames.append((frame_number, frame))
+        return frames
+    finally:
+        cap.release()
+
 
 class VideoProcessor:
     """
     A class to handle video capture, processing, and frame extraction.
     """
     
-    def __init__(self, video_path):
+    def __init__(self, video_path, decode_threads=8):
         """
         Initialize the video processor.
         
         Args:
             video_path (str or Path): Path to the video file
+            decode_threads (int): Number of threads FFmpeg uses to decode the video
         
         Raises:
             FileNotFoundError: If the video file does not exist
@@ -26,7 +80,8 @@ class VideoProcessor:
         if not video_path.exists():
             raise FileNotFoundError(f"Video file not found: {video_path}")
         
-        self.cap = cv2.VideoCapture(str(video_path))
+        self.video_path = video_path
+        self.cap = cv2.VideoCapture(str(video_path), cv2.CAP_FFMPEG, [cv2.CAP_PROP_N_THREADS, decode_threads])
         if not self.cap.isOpened():
             raise ValueError(f"Could not open video file: {video_path}")
         
@@ -35,6 +90,9 @@ class VideoProcessor:
         self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.current_frame = 0
+        
+        # Reused for frames that are decoded but usually not kept (see get_motion_gated_frames)
+        self._buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
     
     def __del__(self):
         """Release the video capture when the object is deleted."""
@@ -83,12 +141,142 @@ class VideoProcessor:
         
         frame_number = 0
         while frame_number < self.frame_count:
+            # Only decode the frames we yield; grab() just advances the stream
+            if not self.cap.grab():
+                break
+            
+            if frame_number % interval == 0:
+                success, frame = self.cap.retrieve()
+                if not success:
+                    break
+                yield frame_number, frame
+            
+            frame_number += 1
+    
+    def get_frame_at_intervals_seek(self, interval):
+        """
+        Generator that yields frames at specified intervals by seeking to each one.
+        
+        Seeking makes the decoder jump to the nearest keyframe before each target
+        instead of walking every frame, which pays off when the interval is much
+        larger than the distance between keyframes. For small intervals the
+        repeated seeks are slower than get_frame_at_intervals.
+        
+        Args:
+            interval (int): Number of frames to skip between each yielded frame
+        
+        Yields:
+            tuple: (frame_number, frame) where frame_number is the current frame number
+                  and frame is the image data
+        """
+        for frame_number in range(0, self.frame_count, interval):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
             success, frame = self.cap.read()
             if not success:
                 break
+            
+            self.current_frame = frame_number + 1
+            yield frame_number, frame
+    
+    def get_frame_at_intervals_parallel(self, interval, workers=None):
+        """
+        Generator that yields frames at specified intervals, decoding in parallel.
+        
+        The video is split into segments of up to SEGMENT_SAMPLES sampled frames and
+        each segment is decoded by a separate process, so independent parts of the
+        stream decode on different cores. Frames are still yielded in order.
+        
+        One segment per worker is in flight at a time, plus the one being yielded.
+        Segments are shortened so those hold about PARALLEL_DECODE_BUDGET bytes of
+        frames, but never less than one frame per segment, so memory use is at
+        most max(PARALLEL_DECODE_BUDGET, (workers + 1) * frame size) approximately.
+        
+        Args:
+            interval (int): Number of frames to skip between each yielded frame
+            workers (int, optional): Number of decoding processes. Defaults to the
+                number of CPUs.
+        
+        Yields:
+            tuple: (frame_number, frame) where frame_number is the current frame number
+                  and frame is the image data
+        """
+        workers = workers or os.cpu_count() or 1
+        frame_bytes = self.width * self.height * 3
+        segment_samples = max(1, min(SEGMENT_SAMPLES, PARALLEL_DECODE_BUDGET // ((workers + 1) * frame_bytes)))
+        segment_length = interval * segment_samples
+        segments = iter(range(0, self.frame_count, segment_length))
+        
+        # Spawn rather than fork: callers may be running other threads
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            pending = collections.deque()
+            
+            def submit_next():
+                start = next(segments, None)
+                if start is not None:
+                    stop = min(start + segment_length, self.frame_count)
+                    pending.append(executor.submit(_decode_segment, str(self.video_path), start, stop, interval))
+            
+            for _ in range(workers):
+                submit_next()
+            
+            # Segments finish out of order; waiting on the oldest keeps the output ordered
+            while pending:
+                frames = pending.popleft().result()
+                submit_next()
+                yield from frames
+    
+    def get_motion_gated_frames(self, min_interval, max_interval, motion_thresh):
+        """
+        Generator that yields frames less often while the scene is still.
+        
+        Every min_interval-th frame is checked for motion by comparing it with the
+        previous checked frame. Each time a frame is yielded without motion, the interval
+        until the next one doubles, up to max_interval; as soon as motion is
+        detected, that frame is yielded and the interval drops back to
+        min_interval. Yielded frame numbers are always multiples of min_interval.
+        
+        Args:
+            min_interval (int): Number of frames between checked frames
+            max_interval (int): Maximum number of frames between yielded frames
+            motion_thresh (float): Fraction of pixels (0-1) that must change for a
+                frame to count as moving
+        
+        Yields:
+            tuple: (frame_number, frame) where frame_number is the current frame number
+                  and frame is the image data
+        """
+        # Reset to beginning of video
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.current_frame = 0
+        
+        previous = None
+        motion_size = (MOTION_FRAME_WIDTH, max(1, round(MOTION_FRAME_WIDTH * self.height / self.width)))
+        interval = min_interval
+        next_frame_number = 0
+        
+        frame_number = 0
+        while frame_number < self.frame_count:
+            if not self.cap.grab():
+                break
+            
+            if frame_number % min_interval == 0:
+                # Decode into the reused buffer; most checked frames are discarded
+                success, self._buffer = self.cap.retrieve(self._buffer)
+                if not success:
+                    break
+                frame = self._buffer
                 
-            if frame_number % interval == 0:
-                yield frame_number, frame
+                # Motion only needs to be measured coarsely
+                gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), motion_size, interpolation=cv2.INTER_AREA)
+                moving = (previous is not None
+                          and motion_energy(previous, gray, MOTION_PIXEL_THRESHOLD) / gray.size >= motion_thresh)
+                previous = gray
+                
+                if moving or frame_number >= next_frame_number:
+                    interval = min_interval if moving else min(interval * 2, max_interval)
+                    next_frame_number = frame_number + interval
+                    yield frame_number, frame.copy()
             
             frame_number += 1
     
@@ -110,6 +298,29 @@ class VideoProcessor:
         h, m = divmod(m, 60)
         return f"{int(h):02d}:{int(m):02d}:{int(s):02d}"
     
+    def timestamps_for(self, frame_numbers):
+        """
+        Convert many frame numbers to timestamps at once.
+        
+        The arithmetic is done with NumPy on the whole array, so only the string
+        formatting runs per frame.
+        
+        Args:
+            frame_numbers (numpy.ndarray): The frame numbers
+        
+        Returns:
+            list: The timestamps in the format 'HH:MM:SS', one per frame number
+        """
+        frame_numbers = np.asarray(frame_numbers)
+        if frame_numbers.size and (frame_numbers.min() < 0 or frame_numbers.max() >= self.frame_count):
+            raise ValueError("Frame numbers are out of bounds")
+        
+        seconds = frame_numbers // self.fps
+        hours = (seconds // 3600).tolist()
+        minutes = (seconds % 3600 // 60).tolist()
+        seconds = (seconds % 60).tolist()
+        return [f"{h:02d}:{m:02d}:{s:02d}" for h, m, s in zip(hours, minutes, seconds)]
+    
     def frames_to_video_position(self, frame_number):
         """
         Convert a frame number to a position in the video (percentage).
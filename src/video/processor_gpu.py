@@ -0,0 +1,84 @@
+"""
+GPU video processor module for decoding and encoding frames on an NVIDIA GPU.
+"""
+from pathlib import Path
+
+
+# Number of sampled frames decoded and encoded on the GPU at once
+GPU_BATCH_SIZE = 16
+
+
+class GPUVideoProcessor:
+    """
+    A class to extract frames with NVDEC and encode them to JPEG with nvJPEG.
+    
+    Frames never leave the GPU as raw pixels: only the JPEG bytes are copied back
+    to the host, ready to be sent to the safety analyzer or written to disk.
+    Requires the optional ``gpu`` dependencies (torch, torchcodec, torchvision).
+    """
+    
+    def __init__(self, video_path, max_dimension=None, jpeg_quality=75, device="cuda"):
+        """
+        Initialize the GPU video processor.
+        
+        Args:
+            video_path (str or Path): Path to the video file
+            max_dimension (int, optional): Downscale frames so their longest side
+                is at most this many pixels before encoding
+            jpeg_quality (int): JPEG quality (1-100)
+            device (str): The CUDA device to decode on
+        
+        Raises:
+            FileNotFoundError: If the video file does not exist
+            ImportError: If the optional GPU dependencies are not installed
+        """
+        video_path = Path(video_path)
+        if not video_path.exists():
+            raise FileNotFoundError(f"Video file not found: {video_path}")
+        
+        try:
+            import torchvision.io
+            import torchvision.transforms.v2.functional
+            from torchcodec.decoders import VideoDecoder
+        except ImportError as e:
+            raise ImportError("GPU decoding requires the optional gpu dependencies. "
+                              "Install them with: uv sync --extra gpu") from e
+        
+        self._encode_jpeg = torchvision.io.encode_jpeg
+        self._resize = torchvision.transforms.v2.functional.resize
+        self.decoder = VideoDecoder(str(video_path), device=device)
+        self.frame_count = self.decoder.metadata.num_frames
+        self.jpeg_quality = jpeg_quality
+        
+        # Output size of the sampled frames, or None to keep the original size
+        self.output_size = None
+        h, w = self.decoder.metadata.height, self.decoder.metadata.width
+        if max_dimension is not None and max(h, w) > max_dimension:
+            scale = max_dimension / max(h, w)
+            self.output_size = [int(h * scale), int(w * scale)]
+    
+    def get_frame_at_intervals(self, interval, frame_count=None):
+        """
+        Generator that yields JPEG-encoded frames at specified intervals.
+        
+        Args:
+            interval (int): Number of frames to skip between each yielded frame
+            frame_count (int, optional): Stop before this frame number even if the
+                GPU decoder reports more frames, e.g. to match the frame count
+                OpenCV estimated for the same video
+        
+        Yields:
+            tuple: (frame_number, jpeg) where frame_number is the current frame number
+                  and jpeg is the encoded image as bytes
+        """
+        if frame_count is None:
+            frame_count = self.frame_count
+        frame_numbers = list(range(0, min(frame_count, self.frame_count), interval))
+        for i in range(0, len(frame_numbers), GPU_BATCH_SIZE):
+            batch = frame_numbers[i:i + GPU_BATCH_SIZE]
+            frames = self.decoder.get_frames_at(indices=batch).data
+            if self.output_size is not None:
+                frames = self._resize(frames, self.output_size, antialias=True)
+            encoded = self._encode_jpeg(list(frames), quality=self.jpeg_quality)
+            for frame_number, jpeg in zip(batch, encoded):
+                yield frame_number, jpeg.cpu().numpy().tobytes()